@@ -32,4 +32,7 @@ CREATE TABLE photo_thumbnails (
   height SMALLINT NOT NULL,
   url TEXT NOT NULL,
   created_at timestamp with time zone DEFAULT now() NOT NULL
-);
\ No newline at end of file
+);
+
+-- cmw: partial index backing the /photos/pending query (status = 'pending' ORDER BY created_at)
+CREATE INDEX photos_pending_created_at_idx ON photos (created_at) WHERE status = 'pending';
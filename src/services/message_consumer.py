@@ -2,21 +2,26 @@ import os
 import logging
 import pika
 import uuid
-import datetime
 import requests
 import io
 import enum
+import functools
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pika.adapters.blocking_connection import BlockingChannel
+from requests.adapters import HTTPAdapter
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import Column, Text, TIMESTAMP, Enum, SmallInteger, ForeignKey
+from sqlalchemy import Column, Text, TIMESTAMP, Enum, SmallInteger, ForeignKey, and_, text
 from sqlalchemy_utils import UUIDType
-from pathlib import Path
 from PIL import Image
 
 THUMBNAIL_DIMENSIONS = 320, 320
 THUMBNAIL_DIR = '/root/waldo-app-thumbs'
 THUMBNAIL_FILE_TYPE = 'JPEG'
 THUMBNAIL_FILE_EXT = '.jpg'
+THUMBNAIL_URL_PREFIX = THUMBNAIL_DIR + '/'
+THUMBNAIL_URL_SUFFIX = '.thumbnail' + THUMBNAIL_FILE_EXT
 if not os.path.exists(THUMBNAIL_DIR):
     os.makedirs(THUMBNAIL_DIR)
 
@@ -35,9 +40,24 @@ db = SQLAlchemy(app)
 
 # instantiate amqp params
 MESSAGE_CHANNEL_NAME = 'photo-processor'
+# number of worker threads processing messages concurrently; matches the database connection pool size
+CONSUMER_WORKER_COUNT = app_config.get('SQLALCHEMY_POOL_SIZE')
+# bound the number of unacknowledged messages the broker pushes to the consumer to what the workers can process
+MESSAGE_PREFETCH_COUNT = CONSUMER_WORKER_COUNT
+# seconds a worker waits before requeueing a message whose photo could not be claimed, e.g. during a database outage
+MESSAGE_RETRY_DELAY = 5
 amqp_params = pika.URLParameters(app_config.get('AMQP_URI'))
 amqp_params._socket_timeout = 5
 
+# instantiate http session; keep-alive connections are pooled and reused across image downloads
+HTTP_POOL_SIZE = 32
+HTTP_TIMEOUT = 3, 10
+HTTP_CHUNK_SIZE = 64 * 1024
+http_session = requests.Session()
+http_adapter = HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE, max_retries=3)
+http_session.mount('https://', http_adapter)
+http_session.mount('http://', http_adapter)
+
 # instantiate logger instance
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
@@ -61,6 +81,11 @@ class ProcessPhotoError(Exception):
     pass
 
 
+class ClaimPhotoError(Exception):
+    """Unable to update the photo record status to `processing`, the photo is left `pending`"""
+    pass
+
+
 # photo status enum
 class PhotoStatusEnum(enum.Enum):
     PENDING = 'pending'
@@ -69,18 +94,26 @@ class PhotoStatusEnum(enum.Enum):
     FAILED = 'failed'
 
 
+# photo status values, resolved once instead of on every processed message
+PHOTO_STATUS_PENDING = PhotoStatusEnum.PENDING.value
+PHOTO_STATUS_PROCESSING = PhotoStatusEnum.PROCESSING.value
+PHOTO_STATUS_COMPLETED = PhotoStatusEnum.COMPLETED.value
+PHOTO_STATUS_FAILED = PhotoStatusEnum.FAILED.value
+
+
 # photos database model
 class Photos(db.Model):
     __table_name__ = 'photos'
 
-    uuid = Column(name='uuid', type_=UUIDType(), primary_key=True, nullable=False, default=uuid.uuid4())
+    uuid = Column(
+        name='uuid', type_=UUIDType(), primary_key=True, nullable=False, server_default=text('gen_random_uuid()'))
     url = Column(name='url', type_=Text, nullable=False)
     status = Column(
         name='status',
         type_=Enum('pending', 'completed', 'processing', 'failed', name='photo_status', create_type=False),
         nullable=False,
         default='pending')
-    created_at = Column(name='created_at', type_=TIMESTAMP, nullable=False, default=datetime.datetime.utcnow())
+    created_at = Column(name='created_at', type_=TIMESTAMP, nullable=False, server_default=text('now()'))
 
     def __repr__(self):
         return '<photo {}>'.format(self.uuid)
@@ -90,12 +123,13 @@ class Photos(db.Model):
 class PhotoThumbnails(db.Model):
     __table_name__ = 'photo_thumbnails'
 
-    uuid = Column(name='uuid', type_=UUIDType(), primary_key=True, nullable=False, default=uuid.uuid4())
+    uuid = Column(
+        name='uuid', type_=UUIDType(), primary_key=True, nullable=False, server_default=text('gen_random_uuid()'))
     photo_uuid = Column('photo_uuid', UUIDType(), ForeignKey('photos.uuid'), nullable=False)
     width = Column(name='width', type_=SmallInteger, nullable=False)
     height = Column(name='height', type_=SmallInteger, nullable=False)
     url = Column(name='url', type_=Text, nullable=False)
-    created_at = Column(name='created_at', type_=TIMESTAMP, nullable=False, default=datetime.datetime.utcnow())
+    created_at = Column(name='created_at', type_=TIMESTAMP, nullable=False, server_default=text('now()'))
 
     def __init__(self, photo_uuid: uuid, width: int, height: int, url: str):
         self.photo_uuid = photo_uuid
@@ -109,9 +143,9 @@ class PhotoThumbnails(db.Model):
 
 def download_img(url: str) -> io.BytesIO:
     """
-    Use the requests framework to download the file from the given url.
+    Use the shared requests session to download the file from the given url, reusing pooled connections.
     If the response `status_code` is not 200 (OK), thrown an `ImgFileDownloadError`.
-    If the image is downloaded successfully, convert the downloaded content to a `io.BytesIO`.
+    If the image is downloaded successfully, stream the response body into a `io.BytesIO` in chunks.
     :param url: string, required
         the url where the image lives to download from
     :return: `io.BytesIO`; the downloaded image content converted to a bytes array
@@ -119,18 +153,22 @@ def download_img(url: str) -> io.BytesIO:
     """
     logger.info(f'download_img() - download the image from the url: {url}')
     try:
-        req: requests.Response = requests.get(url)
-        if req.status_code != 200 or req.content is None:
-            raise ImgFileDownloadError(
-                f'Unable to retrieve image content from url: {url} status code {req.status_code}')
-
-    except (requests.HTTPError, requests.exceptions.ConnectionError) as err:
+        with http_session.get(url, timeout=HTTP_TIMEOUT, stream=True) as req:
+            if req.status_code != 200:
+                raise ImgFileDownloadError(
+                    f'Unable to retrieve image content from url: {url} status code {req.status_code}')
+            img_content = io.BytesIO()
+            for chunk in req.iter_content(chunk_size=HTTP_CHUNK_SIZE):
+                img_content.write(chunk)
+
+    except requests.exceptions.RequestException as err:
         logger.error(
             f'download_img() - http error occurred while downloading the image content from {url} with error {err}'
         )
         raise ImgFileDownloadError(err)
     else:
-        return io.BytesIO(req.content)
+        img_content.seek(0)
+        return img_content
 
 
 def create_img_thumbnail(img_content: io.BytesIO, photo_uuid: uuid) -> PhotoThumbnails:
@@ -154,16 +192,14 @@ def create_img_thumbnail(img_content: io.BytesIO, photo_uuid: uuid) -> PhotoThum
     """
     logger.info('create_img_thumbnail() - create the image thumbnail from the downloaded image')
     try:
-        thumbnail_url = f'{THUMBNAIL_DIR}/{str(photo_uuid)}.thumbnail{THUMBNAIL_FILE_EXT}'
-        thumbnail_path = Path(thumbnail_url)
+        thumbnail_url = THUMBNAIL_URL_PREFIX + str(photo_uuid) + THUMBNAIL_URL_SUFFIX
         with Image.open(img_content) as img:
-            # use pillow to create thumbnail of image & save to the given directory
+            # use pillow to create thumbnail of image & save to the given directory; the resize is skipped by pillow
+            # when the image already fits the thumbnail dimensions, the re-encode still validates & strips the image
             img.thumbnail(THUMBNAIL_DIMENSIONS, Image.ANTIALIAS)
-            img.save(thumbnail_path, THUMBNAIL_FILE_TYPE)
-            # to get actual thumbnail size, open the saved thumbnail
-            with Image.open(thumbnail_url) as thumbnail_img:
-                # get actual image dimensions
-                width, height = thumbnail_img.size
+            # get actual thumbnail dimensions
+            width, height = img.size
+            img.save(thumbnail_url, THUMBNAIL_FILE_TYPE)
     except IOError as err:
         logger.error(f'create_img_thumbnail() - unable to open or create thumbnail image with err {err}')
         raise ImgThumbnailError(err)
@@ -172,61 +208,135 @@ def create_img_thumbnail(img_content: io.BytesIO, photo_uuid: uuid) -> PhotoThum
 
 
 def init_message_consumer():
-    """Init a amqp message consumer to consume any messages on our queue"""
+    """
+    Init a amqp message consumer to consume any messages on our queue.
+    Messages are handed off to a pool of `CONSUMER_WORKER_COUNT` worker threads, so the download, thumbnail and
+    database work of several photos overlap instead of running one message at a time.
+    """
     # build amqp connection and channel
     conn = pika.BlockingConnection(amqp_params)
     channel = conn.channel()
     channel.queue_declare(queue=MESSAGE_CHANNEL_NAME, durable=True)
+    channel.basic_qos(prefetch_count=MESSAGE_PREFETCH_COUNT)
     # consume messages
-    for method_frame, properties, body in channel.consume(MESSAGE_CHANNEL_NAME):
-        # get photo uuid PRIMARY KEY from message body & process
-        photo_uuid = uuid.UUID(bytes=body)
-        process_photo_message(photo_uuid)
-        # acknowledge message
-        channel.basic_ack(method_frame.delivery_tag)
+    with ThreadPoolExecutor(max_workers=CONSUMER_WORKER_COUNT) as executor:
+        for method_frame, properties, body in channel.consume(MESSAGE_CHANNEL_NAME):
+            # get photo uuid PRIMARY KEY from message body & process on a worker thread
+            photo_uuid = uuid.UUID(bytes=body)
+            executor.submit(
+                consume_photo_message, conn, channel, method_frame.delivery_tag, method_frame.redelivered, photo_uuid)
 
     conn.close()
 
 
+def consume_photo_message(
+        conn: pika.BlockingConnection,
+        channel: BlockingChannel,
+        delivery_tag: int,
+        redelivered: bool,
+        photo_uuid: uuid) -> None:
+    """
+    Process the photo message on a worker thread, then acknowledge it.
+    pika connections are not thread safe, so the ack is scheduled back on the consuming thread through
+    `add_callback_threadsafe`.
+    Messages for photos that were marked `failed` or could not be found are acknowledged, as retrying will not help.
+    Messages whose photo could not be claimed are requeued once, after `MESSAGE_RETRY_DELAY` seconds, so a database
+    outage does not turn into a redelivery busy loop; a redelivered message failing again, or any other unexpected
+    error, is rejected without being requeued.
+    :param conn: `pika.BlockingConnection`, required
+        the connection the message was consumed from
+    :param channel: `BlockingChannel`, required
+        the channel the message was consumed from
+    :param delivery_tag: int, required
+        the delivery tag of the message to acknowledge
+    :param redelivered: bool, required
+        whether the message was delivered before
+    :param photo_uuid: uuid, required
+        the PK id of the photo being processed
+    """
+    ack = functools.partial(channel.basic_ack, delivery_tag)
+    try:
+        process_photo_message(photo_uuid)
+    except (NoPhotoRecordFoundError, ProcessPhotoError) as ex:
+        logger.error(f'consume_photo_message() - unable to process photo with id {photo_uuid} with error {ex}')
+    except ClaimPhotoError as ex:
+        logger.error(f'consume_photo_message() - unable to claim photo with id {photo_uuid} with error {ex}')
+        if redelivered:
+            ack = functools.partial(channel.basic_nack, delivery_tag, requeue=False)
+        else:
+            time.sleep(MESSAGE_RETRY_DELAY)
+            ack = functools.partial(channel.basic_nack, delivery_tag, requeue=True)
+    except Exception:
+        logger.exception(f'consume_photo_message() - unexpected error processing photo with id {photo_uuid}')
+        ack = functools.partial(channel.basic_nack, delivery_tag, requeue=False)
+    finally:
+        # release this thread's database session back to the pool
+        db.session.remove()
+
+    conn.add_callback_threadsafe(ack)
+
+
+def update_photo_status(photo_uuid: uuid, status: str) -> None:
+    """
+    Update the status of the photo record with the given PK uuid value, without loading the record first.
+    The update is executed in the current session transaction, it is not committed.
+    :param photo_uuid: uuid, required
+        the PK id of the photo to update
+    :param status: string, required
+        the `PhotoStatusEnum` value to set on the photo record
+    """
+    db.session.execute(Photos.__table__.update().where(Photos.uuid == photo_uuid).values(status=status))
+
+
 def process_photo_message(photo_uuid: uuid) -> None:
     """
     Process the photo with the given PK uuid value.
-        - Retrieve the photo from the database
-        - Update the photo record status to be `processing`
+        - Update the photo record status from `pending` to be `processing`, returning its url in the same round-trip
         - Download the img file using the requests library
         - Use the pillow lib to create a 320x320 thumbnail of the img
         - Store thumbnail to `/waldo-app-thumbs` directory
-        - If successful:
+        - If successful, in a single transaction:
             - Create a new photo_thumbnails record in the database with the thumbnail details
             - Update the status of the photo record to be `completed`
-        - If failure: update the status of the photo record to be `failed`
+        - If any failure once the photo is `processing`: update the status of the photo record to be `failed`
     :param photo_uuid: uuid, required
         the PK id of the photo being processed
-    :raises NoPhotoRecordFoundError; raised if no photo record can be found by the `photo_uuid` primary key
+    :raises NoPhotoRecordFoundError; raised if no `pending` photo record can be found by the `photo_uuid` primary key,
+        this also makes redelivered messages for an already processed photo a no-op
+    :raises ClaimPhotoError; raised if the photo record status could not be updated to `processing`
+    :raises ProcessPhotoError; raised if processing the photo failed and the photo record was marked `failed`
     """
     logger.info(f'process_photo() - processing photo request with id {str(photo_uuid)}')
-    # retrieve the photo record
-    photo: Photos = Photos.query.get(photo_uuid)
+    try:
+        # update the pending photo record status to processing & retrieve its url
+        photo = db.session.execute(
+            Photos.__table__.update()
+            .where(and_(Photos.uuid == photo_uuid, Photos.status == PHOTO_STATUS_PENDING))
+            .values(status=PHOTO_STATUS_PROCESSING)
+            .returning(Photos.url)
+        ).first()
+        db.session.commit()
+    except Exception as ex:
+        # the photo is still `pending`, leave it to a redelivery of the message
+        db.session.rollback()
+        raise ClaimPhotoError(ex)
     if photo is None:
-        raise NoPhotoRecordFoundError(f'No photo record found with id {str(photo_uuid)}')
+        raise NoPhotoRecordFoundError(f'No pending photo record found with id {str(photo_uuid)}')
 
     try:
-        # update the photo status to processing
-        photo.status = PhotoStatusEnum.PROCESSING.value
-        db.session.commit()
         # download the image file
         img_content: io.BytesIO = download_img(photo.url)
         # create the thumbnail image
         photo_thumbnail: PhotoThumbnails = create_img_thumbnail(img_content, photo_uuid)
+        # store the thumbnail record & update photo status to completed in a single transaction
         db.session.add(photo_thumbnail)
+        update_photo_status(photo_uuid, PHOTO_STATUS_COMPLETED)
         db.session.commit()
-        # update photo status to completed
-        photo.status = PhotoStatusEnum.COMPLETED.value
-        db.session.commit()
-    except (ImgFileDownloadError, ImgThumbnailError) as ex:
+    except Exception as ex:
         logger.error(f'process_photo() - an error occurred processing photo with id {photo_uuid} with error {ex}')
+        db.session.rollback()
         # update photo status to failed
-        photo.status = PhotoStatusEnum.FAILED.value
+        update_photo_status(photo_uuid, PHOTO_STATUS_FAILED)
         db.session.commit()
         # raise process photo error
         raise ProcessPhotoError(ex)
@@ -1,12 +1,13 @@
 import os
 import logging
 import enum
-import datetime
 import uuid
+import threading
 import pika
+from pika.adapters.blocking_connection import BlockingChannel
 from flask import Flask, jsonify, request
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import Column, Text, TIMESTAMP, Enum
+from sqlalchemy import Column, Text, TIMESTAMP, Enum, text
 from sqlalchemy_utils import UUIDType
 
 # application configuration
@@ -32,6 +33,11 @@ amqp_uri = app.config.get('AMQP_URI')
 amqp_params = pika.URLParameters(amqp_uri)
 amqp_params._socket_timeout = 5
 
+# amqp connection && channel shared across requests; pika connections are not thread safe, so guard with a lock
+amqp_lock = threading.Lock()
+amqp_conn: pika.BlockingConnection = None
+amqp_channel: BlockingChannel = None
+
 
 # photo status enum
 class PhotoStatusEnum(enum.Enum):
@@ -45,21 +51,19 @@ class PhotoStatusEnum(enum.Enum):
 class Photos(db.Model):
     __table_name__ = 'photos'
 
-    uuid = Column(name='uuid', type_=UUIDType(), primary_key=True, nullable=False, default=uuid.uuid4())
+    uuid = Column(
+        name='uuid', type_=UUIDType(), primary_key=True, nullable=False, server_default=text('gen_random_uuid()'))
     url = Column(name='url', type_=Text, nullable=False)
     status = Column(
         name='status',
         type_=Enum('pending', 'completed', 'processing', 'failed', name='photo_status', create_type=False),
         nullable=False,
         default='pending')
-    created_at = Column(name='created_at', type_=TIMESTAMP, nullable=False, default=datetime.datetime.utcnow())
+    created_at = Column(name='created_at', type_=TIMESTAMP, nullable=False, server_default=text('now()'))
 
     def __repr__(self):
         return '<photo {}>'.format(self.uuid)
 
-    def to_dict(self) -> dict:
-        return {'uuid': self.uuid, 'url': self.url, 'status': self.status, 'created_at': self.created_at}
-
 
 class ProcessPhotosRequest(object):
 
@@ -74,26 +78,91 @@ class ProcessPhotosRequest(object):
         return {'uuids': self.uuids}
 
 
+def uuid_to_bytes(value: str) -> bytes:
+    """
+    Convert the uuid string to its 16 bytes representation, without building the intermediate `uuid.UUID` instance.
+    Accepts the same string forms as `uuid.UUID(value)`: hex with or without dashes, optionally wrapped in braces or
+    prefixed with `urn:uuid:`.
+    :param value: string, required
+        the uuid string
+    :return: bytes; the 16 bytes of the uuid
+    :raises ValueError; raised if the value is not a valid uuid string
+    """
+    # strip the same decorations as `uuid.UUID`, then require exactly 32 hex digits; checking the length up front
+    # also rejects the whitespace `bytes.fromhex` would otherwise skip
+    hex_str = value.replace('urn:', '').replace('uuid:', '').strip('{}').replace('-', '')
+    if len(hex_str) != 32:
+        raise ValueError(f'badly formed uuid string: {value}')
+    uuid_bytes = bytes.fromhex(hex_str)
+    if len(uuid_bytes) != 16:
+        raise ValueError(f'badly formed uuid string: {value}')
+    return uuid_bytes
+
+
+def get_amqp_channel() -> BlockingChannel:
+    """
+    Return the amqp channel shared across requests, (re)building it if it does not exist yet or has been closed.
+    When the channel is built, the queue is declared and the channel is put in transaction mode once, instead of on
+    every request. Must be called while holding the `amqp_lock`.
+    :return: `BlockingChannel`; the open amqp channel to publish messages on
+    """
+    global amqp_conn, amqp_channel
+    if amqp_conn is not None and amqp_conn.is_open and amqp_channel.is_open:
+        try:
+            # service any heartbeats that were missed while the connection sat idle between requests
+            amqp_conn.process_data_events()
+            return amqp_channel
+        except pika.exceptions.AMQPError as err:
+            logger.warning(f'get_amqp_channel() - amqp connection lost, reconnecting. error {err}')
+
+    # close any previous connection, e.g. one still open whose channel was closed, before building a new one
+    if amqp_conn is not None:
+        reset_amqp_connection()
+    # build amqp connection and channel
+    amqp_conn = pika.BlockingConnection(amqp_params)
+    amqp_channel = amqp_conn.channel()
+    amqp_channel.queue_declare(queue=MESSAGE_CHANNEL_NAME, durable=True)
+    amqp_channel.tx_select()
+    return amqp_channel
+
+
+def reset_amqp_connection() -> None:
+    """Close the shared amqp connection, if any, so the next `get_amqp_channel` call builds a new one"""
+    global amqp_conn, amqp_channel
+    if amqp_conn is not None and amqp_conn.is_open:
+        try:
+            amqp_conn.close()
+        except pika.exceptions.AMQPError:
+            pass
+    amqp_conn = None
+    amqp_channel = None
+
+
 def process_photos(process_photos_request: ProcessPhotosRequest) -> None:
     """
     Publish a rabbitmq message for each photo to process as uploaded in the `ProcessPhotoRequest`.
-    Instantiate a `pika.BlockingConnection`, build a channel from the connection, declare a queue, iterate through each
-    photo primary key id uploaded in the request and publish it as a message on the queue.
-    Once finished, close the connection.
+    Retrieve the shared amqp channel, iterate through each photo primary key id uploaded in the request and publish it
+    as a message on the queue.
+    The messages are published inside a single amqp transaction, so the broker acknowledges the whole batch with one
+    round-trip instead of one per message.
+    If publishing fails, the shared connection is reset so the next request reconnects.
     :param process_photos_request: `ProcessPhotosRequest`, required
         the parsed received request for processing the photos. contains a list of photo primary keys to be processed
     """
-    # build amqp connection and channel
-    conn = pika.BlockingConnection(amqp_params)
-    channel = conn.channel()
-    channel.queue_declare(queue=MESSAGE_CHANNEL_NAME, durable=True)
-    # publish messages
-    for i in process_photos_request.uuids:
-        photo_uuid = uuid.UUID(i)
-        channel.basic_publish(exchange='', routing_key=MESSAGE_CHANNEL_NAME, body=photo_uuid.bytes)
-
-    # close the connection
-    conn.close()
+    # parse every uuid up front, so an invalid one cannot leave a partially published transaction on the channel
+    photo_uuids: [bytes] = [uuid_to_bytes(i) for i in process_photos_request.uuids]
+    with amqp_lock:
+        try:
+            channel = get_amqp_channel()
+            # publish messages
+            for photo_uuid in photo_uuids:
+                channel.basic_publish(exchange='', routing_key=MESSAGE_CHANNEL_NAME, body=photo_uuid, mandatory=False)
+            # wait once for the broker to accept the whole batch
+            channel.tx_commit()
+        except pika.exceptions.AMQPError as err:
+            logger.error(f'process_photos() - unable to publish photo messages with error {err}')
+            reset_amqp_connection()
+            raise
 
 
 @app.route('/')
@@ -103,8 +172,12 @@ def index():
 
 @app.route('/photos/pending', methods=['GET'])
 def get_pending_photos_handler():
-    photos: [Photos] = Photos.query.filter_by(status=PhotoStatusEnum.PENDING.value).order_by(Photos.created_at).all()
-    photos_json: [dict] = list(map(lambda i: i.to_dict(), photos))
+    # select the columns as plain rows, skipping the orm instance hydration of each photo
+    photos = db.session.query(Photos.uuid, Photos.url, Photos.status, Photos.created_at) \
+        .filter(Photos.status == PhotoStatusEnum.PENDING.value) \
+        .order_by(Photos.created_at) \
+        .all()
+    photos_json: [dict] = [photo._asdict() for photo in photos]
     return jsonify(photos_json)
 
 